@@ -1,239 +1,2065 @@
+import argparse
+import csv
 import requests
-from bs4 import BeautifulSoup
 from dataclasses import dataclass
-from typing import List, Dict
+from typing import List, Dict, Iterable, Iterator, NamedTuple, Optional, Tuple
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import gzip
 import json
+import os
+import re
+import shutil
+import sys
+import sqlite3
+from urllib.parse import urlencode
 import time
 import random
 from datetime import datetime, timezone, timedelta
-import pandas as pd
+from email.utils import parsedate_to_datetime
+import numpy as np
 
-@dataclass
-class Comment:
+# Необязательные быстрые JSON-декодеры: msgspec (типизированные структуры),
+# затем orjson, иначе стандартный json
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+API_BASE_URL = "https://api.t-j.ru/ipa-gateway/api/v1"
+PAGE_SIZE = 100
+GROUPS = ('only_likes', 'only_dislikes', 'both')
+THROTTLE_STATUSES = (429, 503)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+REQUEST_TIMEOUT = 30
+# Параметр шлюза для отбора комментариев не старше заданной даты.
+# Шлюз его не документирует, поэтому по умолчанию отбор только на клиенте.
+DATE_FILTER_PARAM = None
+# Сколько комментариев нужно собрать в каждую группу
+GROUP_TARGET = 2000
+CACHE_TTL = 24 * 60 * 60
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+JOURNAL_PATH = 'crawl_journal.jsonl'
+JOURNAL_SYNC_EVERY = 50
+OUTPUT_PATH = 'comments.csv'
+CSV_BUFFER_SIZE = 1024 * 1024
+PARQUET_ROW_GROUP_SIZE = 64 * 1024
+PARQUET_COMPRESSION = 'zstd'
+SQLITE_BATCH_SIZE = 10000
+BLOOM_CAPACITY = 10_000_000
+BLOOM_ERROR_RATE = 0.001
+# Минимальная сумма лайков и дизлайков и глубина обхода в днях
+MIN_VOTES = 5
+CUTOFF_DAYS = 365
+INVALID_TIMESTAMP = np.iinfo(np.int64).min
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+    'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'none',
+    'Sec-Fetch-User': '?1',
+    'Cache-Control': 'max-age=0'
+}
+
+
+class CommentBatch:
+    """
+    Колоночный пакет отфильтрованных комментариев (страница или пользователь).
+
+    Числовые поля — массивы NumPy с типами из COLUMNS, group — индекс в GROUPS,
+    ban — 1/0 и -1 для отсутствующего значения; status и article_path —
+    массивы строк.
+    """
+
+    COLUMNS = (
+        ('id', np.int64),
+        ('likes', np.int32),
+        ('dislikes', np.int32),
+        ('user_vote', np.int8),
+        ('ban', np.int8),
+        ('timestamp', np.int64),
+        ('group', np.int8),
+    )
+    STRING_COLUMNS = ('status', 'article_path')
+
+    def __init__(self, columns: Dict[str, np.ndarray]):
+        self.columns = columns
+
+    @classmethod
+    def empty(cls) -> 'CommentBatch':
+        columns = {name: np.empty(0, dtype) for name, dtype in cls.COLUMNS}
+        columns.update({name: np.empty(0, object) for name in cls.STRING_COLUMNS})
+        return cls(columns)
+
+    @classmethod
+    def from_lists(cls, columns: Dict[str, list]) -> 'CommentBatch':
+        arrays = {name: np.asarray(columns[name], dtype) for name, dtype in cls.COLUMNS}
+        for name in cls.STRING_COLUMNS:
+            arrays[name] = np.array([sys.intern(value) for value in columns[name]], dtype=object)
+        return cls(arrays)
+
+    @classmethod
+    def concat(cls, batches: List['CommentBatch']) -> 'CommentBatch':
+        if not batches:
+            return cls.empty()
+        if len(batches) == 1:
+            return batches[0]
+        return cls({name: np.concatenate([batch.columns[name] for batch in batches])
+                    for name in batches[0].columns})
+
+    def __len__(self) -> int:
+        return len(self.columns['id'])
+
+    def select(self, mask: np.ndarray) -> 'CommentBatch':
+        if mask.all():
+            return self
+        return CommentBatch({name: column[mask] for name, column in self.columns.items()})
+
+    def group_counts(self) -> np.ndarray:
+        return np.bincount(self.columns['group'], minlength=len(GROUPS))
+
+    def to_lists(self) -> Dict[str, list]:
+        return {name: column.tolist() for name, column in self.columns.items()}
+
+
+class CommentRow(NamedTuple):
+    """
+    Комментарий из ответа API: только используемые поля
+    """
     id: int
     likes: int
     dislikes: int
     user_vote: int
+    ban: Optional[bool]
+    date_added: Optional[str]
     status: str
-    ban: bool
-    date_added: datetime
-    url: str
+    article_path: str
+
 
-def get_user_comments(session: requests.Session, account_id: int) -> Dict[str, List[Comment]]:
+class CommentPage(NamedTuple):
     """
-    Получает все комментарии пользователя по его ID и разделяет их на группы
+    Разобранная страница комментариев
+    """
+    count: int
+    next: Optional[str]
+    rows: List[CommentRow]
+
+
+class UserComments(NamedTuple):
+    """
+    Результат обхода пользователя: отобранные комментарии, самый новый
+    комментарий (id, date_added) для отметки уровня и признак полного обхода
+    (complete — False, если обход прерван stop_event)
+    """
+    batch: 'CommentBatch'
+    newest: Optional[Tuple[int, Optional[str]]] = None
+    complete: bool = True
+
+
+def loads_json(body: bytes):
+    return orjson.loads(body) if orjson else json.loads(body)
+
+
+if msgspec:
+    # Любое поле может прийти null: как и в разборе через json, оно
+    # заменяется значением по умолчанию в decode_comment_page
+    class RatingPayload(msgspec.Struct):
+        likes: Optional[int] = 0
+        dislikes: Optional[int] = 0
+        user_vote: Optional[int] = 0
+
+    class CommentPayload(msgspec.Struct):
+        id: Optional[int] = -1
+        rating: Optional[RatingPayload] = None
+        status: Optional[str] = ''
+        ban: Optional[bool] = None
+        date_added: Optional[str] = None
+        article_path: Optional[str] = ''
+
+    class PagePayload(msgspec.Struct):
+        count: Optional[int] = 0
+        next: Optional[str] = None
+        data: Optional[List[CommentPayload]] = None
+
+    PAGE_DECODER = msgspec.json.Decoder(PagePayload, strict=False)
+    EMPTY_RATING = RatingPayload()
+else:
+    PAGE_DECODER = None
+
+
+def decode_comment_page(body: bytes) -> CommentPage:
+    """
+    Разбирает тело ответа со страницей комментариев.
+
+    С msgspec тело декодируется сразу в типизированные структуры: лишние поля
+    пропускаются без создания объектов, типы нужных проверяются нестрого:
+    ban 1/0 читается как true/false, как и без msgspec; несовместимые
+    значения — msgspec.ValidationError, подкласс ValueError.
+    Без msgspec используется orjson или стандартный json.
+    Оба варианта одинаково заменяют null: числа — 0 (id — -1), строки — ''.
+    """
+    if PAGE_DECODER is not None:
+        page = PAGE_DECODER.decode(body)
+        rows = []
+        for comment in page.data or ():
+            rating = comment.rating or EMPTY_RATING
+            rows.append(CommentRow(-1 if comment.id is None else comment.id, rating.likes or 0,
+                                   rating.dislikes or 0, rating.user_vote or 0, comment.ban,
+                                   comment.date_added, comment.status or '', comment.article_path or ''))
+        return CommentPage(page.count or 0, page.next, rows)
+
+    data = loads_json(body)
+    rows = []
+    for comment in data.get('data') or ():
+        rating = comment.get('rating') or {}
+        comment_id = comment.get('id')
+        rows.append(CommentRow(-1 if comment_id is None else comment_id, rating.get('likes') or 0,
+                               rating.get('dislikes') or 0, rating.get('user_vote') or 0, comment.get('ban'),
+                               comment.get('date_added'), comment.get('status') or '',
+                               comment.get('article_path') or ''))
+    return CommentPage(data.get('count') or 0, data.get('next'), rows)
+
+
+def is_utc_timestamp(value) -> bool:
+    """
+    Строка в формате API: 'YYYY-MM-DDTHH:MM:SS[.ffffff]' с суффиксом Z или +00:00
+    """
+    return (isinstance(value, str) and len(value) >= 20 and value[10] == 'T'
+            and (value[-1] == 'Z' or value.endswith('+00:00')))
+
+
+def parse_timestamp(value) -> int:
+    """
+    Переводит одну дату из API в Unix-время (секунды); при ошибке — INVALID_TIMESTAMP
+    """
+    try:
+        return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp())
+    except (AttributeError, TypeError, ValueError):
+        return INVALID_TIMESTAMP
+
+
+def parse_timestamps(values) -> np.ndarray:
     """
-    base_url = f"https://api.t-j.ru/ipa-gateway/api/v1/profiles/{account_id}/comments/"
-    comments = {
-        'only_likes': [],
-        'only_dislikes': [],
-        'both': []
+    Векторный вариант parse_timestamp для всей страницы: у строк в формате API
+    отрезается смещение, и первые 19 символов разбирает NumPy (datetime64[s])
+    без создания datetime; остальные строки — по одной через parse_timestamp
+    """
+    fast = [is_utc_timestamp(value) for value in values]
+    try:
+        timestamps = np.array([value[:19] if ok else 'NaT' for value, ok in zip(values, fast)],
+                              dtype='datetime64[s]').astype(np.int64)
+    except ValueError:
+        return np.fromiter((parse_timestamp(value) for value in values), np.int64, len(values))
+    # NaT в int64 совпадает с INVALID_TIMESTAMP
+    for index, ok in enumerate(fast):
+        if not ok:
+            timestamps[index] = parse_timestamp(values[index])
+    return timestamps
+
+
+def classify_page(rows: List[CommentRow], cutoff: int, since_id: Optional[int] = None,
+                  min_votes: int = MIN_VOTES) -> Tuple[CommentBatch, bool]:
+    """
+    Фильтрует комментарии одной страницы и раскладывает их по группам
+    векторно: маски порога голосов, даты и метки групп считаются NumPy
+    за один проход по странице.
+
+    API отдаёт комментарии от новых к старым, поэтому первый комментарий
+    старше cutoff (Unix-время) или с id не больше since_id — уже собранный
+    в прошлый раз — означает, что дальше смотреть не нужно: в этом случае
+    вторым значением возвращается True, и обход пользователя прекращается.
+    """
+    if not rows:
+        return CommentBatch.empty(), False
+
+    ids, likes, dislikes, user_votes, bans, dates, statuses, paths = zip(*rows)
+    ids = np.array(ids, np.int64)
+    likes = np.array(likes, np.int32)
+    dislikes = np.array(dislikes, np.int32)
+    timestamps = parse_timestamps(dates)
+
+    valid = timestamps != INVALID_TIMESTAMP
+    stop_mask = valid & (timestamps < cutoff)
+    if since_id is not None:
+        stop_mask |= ids <= since_id
+    reached_end = bool(stop_mask.any())
+    end = int(stop_mask.argmax()) if reached_end else len(rows)
+
+    likes, dislikes = likes[:end], dislikes[:end]
+    groups = np.select(
+        [(likes > 0) & (dislikes > 0), likes > 0, dislikes > 0],
+        [GROUPS.index('both'), GROUPS.index('only_likes'), GROUPS.index('only_dislikes')],
+        -1
+    ).astype(np.int8)
+
+    # Пропускаем комментарии без лайков и дизлайков
+    # или с суммой лайков и дизлайков меньше min_votes
+    keep = np.flatnonzero(valid[:end] & (likes + dislikes >= min_votes) & (groups >= 0))
+
+    batch = CommentBatch({
+        'id': ids[keep],
+        'likes': likes[keep],
+        'dislikes': dislikes[keep],
+        'user_vote': np.array(user_votes, np.int8)[keep],
+        'ban': np.array([-1 if ban is None else int(ban) for ban in bans], np.int8)[keep],
+        'timestamp': timestamps[keep],
+        'group': groups[keep],
+        'status': np.array([sys.intern(status) for status in statuses], dtype=object)[keep],
+        'article_path': np.array([sys.intern(path) for path in paths], dtype=object)[keep],
+    })
+    return batch, reached_end
+
+
+class RateLimiter:
+    """
+    Token bucket: в среднем rate запросов в секунду, пачкой до burst.
+
+    Один экземпляр разделяется между потоками и asyncio-задачами.
+    С shared=True состояние корзины лежит в разделяемой памяти
+    (multiprocessing.Array), и лимит общий для дочерних процессов,
+    которым экземпляр передан при запуске.
+    """
+
+    # Индексы в self.state
+    TOKENS, UPDATED, RATE, PAUSED_UNTIL = range(4)
+
+    def __init__(self, rate: float, burst: int = 1, shared: bool = False):
+        self.burst = max(1, burst)
+        initial = self.initial_state(rate)
+        if shared:
+            self.state = multiprocessing.Array('d', initial)
+            self.lock = self.state.get_lock()
+        else:
+            self.state = initial
+            self.lock = threading.Lock()
+
+    def initial_state(self, rate: float) -> List[float]:
+        """
+        Начальные значения self.state; наследники дописывают свои поля в конец
+        """
+        return [float(self.burst), time.monotonic(), float(rate), 0.0]
+
+    @property
+    def rate(self) -> float:
+        return self.state[self.RATE]
+
+    def reserve(self) -> float:
+        """
+        Забирает токен и возвращает, сколько секунд нужно подождать до запроса
+        """
+        with self.lock:
+            now = time.monotonic()
+            pause = self.state[self.PAUSED_UNTIL] - now
+            rate = self.state[self.RATE]
+            if rate <= 0:
+                return max(pause, 0.0)
+            tokens = min(self.burst, self.state[self.TOKENS] + (now - self.state[self.UPDATED]) * rate)
+            tokens -= 1
+            self.state[self.TOKENS] = tokens
+            self.state[self.UPDATED] = now
+        return max(-tokens / rate, pause, 0.0)
+
+    def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Приостанавливает выдачу токенов всем потребителям на seconds секунд
+        """
+        with self.lock:
+            until = time.monotonic() + seconds
+            self.state[self.PAUSED_UNTIL] = max(self.state[self.PAUSED_UNTIL], until)
+
+    def on_response(self, status: int, latency: float, retry_after: Optional[float] = None) -> None:
+        """
+        Обратная связь от ответа сервера; обычный token bucket учитывает только Retry-After
+        """
+        if retry_after:
+            self.pause(retry_after)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """
+    Token bucket, частота которого подстраивается по AIMD:
+    на 429/503 и рост задержки частота умножается на decrease (не чаще раза
+    в cooldown секунд), на каждый здоровый ответ растёт на increase / rate,
+    т.е. примерно на increase запросов в секунду за секунду.
+    Задержка считается выросшей относительно базовой: базовая сразу
+    опускается до текущей EWMA, а вверх медленно следует за ней с долей
+    baseline_drift, поэтому устойчивый сдвиг задержки со временем
+    принимается за новую норму. С rate <= 0 лимита нет и подстраивать нечего.
+    Время последнего снижения и оценки задержки лежат в self.state рядом
+    с частотой, поэтому с shared=True процессы снижают общую частоту
+    один раз за cooldown, а не каждый по отдельности.
+    """
+
+    # Индексы в self.state после полей RateLimiter; 0 — задержка ещё не измерена
+    LAST_DECREASE, LATENCY_EWMA, LATENCY_BASELINE = range(4, 7)
+
+    def __init__(self, rate: float, burst: int = 1, shared: bool = False,
+                 min_rate: float = 0.2, max_rate: Optional[float] = None,
+                 increase: float = 0.5, decrease: float = 0.5,
+                 latency_factor: float = 2.0, cooldown: float = 1.0, baseline_drift: float = 0.02):
+        super().__init__(rate, burst, shared)
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate * 5
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.baseline_drift = baseline_drift
+
+    def initial_state(self, rate: float) -> List[float]:
+        return super().initial_state(rate) + [0.0, 0.0, 0.0]
+
+    def on_response(self, status: int, latency: float, retry_after: Optional[float] = None) -> None:
+        super().on_response(status, latency, retry_after)
+        state = self.state
+        with self.lock:
+            if status < 400:
+                ewma = state[self.LATENCY_EWMA]
+                ewma = 0.8 * ewma + 0.2 * latency if ewma else latency
+                baseline = state[self.LATENCY_BASELINE] or ewma
+                baseline += self.baseline_drift * (ewma - baseline)
+                state[self.LATENCY_EWMA] = ewma
+                state[self.LATENCY_BASELINE] = min(baseline, ewma)
+            ewma = state[self.LATENCY_EWMA]
+            slow = ewma > 0 and ewma > self.latency_factor * state[self.LATENCY_BASELINE]
+
+            rate = state[self.RATE]
+            if rate <= 0:
+                return
+            now = time.monotonic()
+            if status in THROTTLE_STATUSES or slow:
+                if now - state[self.LAST_DECREASE] >= self.cooldown:
+                    state[self.RATE] = max(self.min_rate, rate * self.decrease)
+                    state[self.LAST_DECREASE] = now
+            elif status < 400:
+                state[self.RATE] = min(self.max_rate, rate + self.increase / rate)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Разбирает заголовок Retry-After: число секунд или HTTP-дата
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (moment - datetime.now(timezone.utc)).total_seconds())
+
+
+@dataclass
+class RetryPolicy:
+    """
+    Политика повторов одного запроса: до max_attempts попыток с
+    экспоненциальной паузой и полным jitter между ними
+    """
+    max_attempts: int = 5
+    base_delay: float = 0.5
+    max_delay: float = 30.0
+    retry_statuses: tuple = RETRY_STATUSES
+
+    def is_retryable(self, status: int) -> bool:
+        return status in self.retry_statuses
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+@dataclass
+class CommentQuery:
+    """
+    Что запрашивать и что оставлять: размер страницы API, окно в днях
+    (более старые комментарии не собираются) и минимальная сумма голосов
+    """
+    page_size: int = PAGE_SIZE
+    cutoff_days: int = CUTOFF_DAYS
+    min_votes: int = MIN_VOTES
+
+    def since(self) -> datetime:
+        return datetime.now(timezone.utc) - timedelta(days=self.cutoff_days)
+
+
+DEFAULT_COMMENT_QUERY = CommentQuery()
+
+
+class ResponseCache:
+    """
+    Дисковый кэш ответов API в SQLite: ключ — URL запроса с параметрами
+    (т.е. пользователь и страница), значение — тело ответа.
+
+    Записи старше ttl секунд считаются устаревшими и запрашиваются заново.
+    Когда суммарный размер тел превышает max_bytes, вытесняются записи,
+    к которым дольше всего не обращались (LRU).
+    """
+
+    def __init__(self, path: str, ttl: float = CACHE_TTL, max_bytes: int = CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, body BLOB NOT NULL, size INTEGER NOT NULL, '
+            'created REAL NOT NULL, accessed REAL NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def key(url: str, params: Optional[dict]) -> str:
+        return f"{url}?{urlencode(sorted(params.items()))}" if params else url
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT body, size, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            body, size, created = row
+            if now - created > self.ttl:
+                self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.total_bytes -= size
+                return None
+            self.conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        return body
+
+    def put(self, key: str, body: bytes) -> None:
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if row:
+                self.total_bytes -= row[0]
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                              (key, body, len(body), now, now))
+            self.total_bytes += len(body)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self) -> None:
+        """
+        Удаляет самые давно использованные записи, пока кэш не уложится в max_bytes
+        """
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute('SELECT key, size FROM responses ORDER BY accessed LIMIT 100').fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            self.conn.execute('BEGIN')
+            for key, size in rows:
+                self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+            self.conn.execute('COMMIT')
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+class WatermarkStore:
+    """
+    Отметки уровня (high-water mark) по пользователям в SQLite:
+    id и дата самого нового комментария из последнего полного обхода.
+    Следующий обход пользователя останавливается, дойдя до этого id.
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS watermarks ('
+            'account_id INTEGER PRIMARY KEY, last_id INTEGER NOT NULL, '
+            'last_date TEXT, updated REAL NOT NULL)'
+        )
+
+    def get(self, account_id: int) -> Optional[int]:
+        with self.lock:
+            row = self.conn.execute('SELECT last_id FROM watermarks WHERE account_id = ?', (account_id,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, account_id: int, last_id: int, last_date: Optional[str]) -> None:
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?)',
+                (account_id, last_id, last_date, time.time())
+            )
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+def fetch_json(session: requests.Session, url: str, params: Optional[dict],
+               rate_limiter: Optional[RateLimiter] = None,
+               retry_policy: Optional[RetryPolicy] = None,
+               cache: Optional[ResponseCache] = None, decode=loads_json):
+    """
+    GET-запрос через ограничитель частоты с передачей ему обратной связи.
+    Сетевые сбои и ответы из retry_policy.retry_statuses повторяются,
+    чтобы единичная ошибка стоила одного повторного запроса страницы.
+    Свежий ответ из cache возвращается без обращения к сети.
+    Тело ответа разбирается функцией decode.
+    """
+    if cache:
+        key = cache.key(url, params)
+        body = cache.get(key)
+        if body is not None:
+            return decode(body)
+
+    policy = retry_policy or DEFAULT_RETRY_POLICY
+    for attempt in range(policy.max_attempts):
+        last_attempt = attempt == policy.max_attempts - 1
+        if rate_limiter:
+            rate_limiter.acquire()
+        started = time.monotonic()
+        try:
+            response = session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout):
+            if last_attempt:
+                raise
+            time.sleep(policy.backoff(attempt))
+            continue
+        latency = time.monotonic() - started
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        if rate_limiter:
+            rate_limiter.on_response(response.status_code, latency, retry_after)
+
+        if policy.is_retryable(response.status_code) and not last_attempt:
+            # Retry-After уже учтён ограничителем как общая пауза
+            if retry_after is None:
+                time.sleep(policy.backoff(attempt))
+            elif not rate_limiter:
+                time.sleep(retry_after)
+            continue
+
+        response.raise_for_status()
+        if cache:
+            cache.put(key, response.content)
+        return decode(response.content)
+
+
+async def fetch_json_async(session, url: str, params: Optional[dict],
+                           rate_limiter: Optional[RateLimiter] = None,
+                           retry_policy: Optional[RetryPolicy] = None,
+                           cache: Optional[ResponseCache] = None, decode=loads_json):
+    """
+    Асинхронный вариант fetch_json для aiohttp.ClientSession
+    """
+    import aiohttp
+
+    if cache:
+        key = cache.key(url, params)
+        body = cache.get(key)
+        if body is not None:
+            return decode(body)
+
+    policy = retry_policy or DEFAULT_RETRY_POLICY
+    for attempt in range(policy.max_attempts):
+        last_attempt = attempt == policy.max_attempts - 1
+        if rate_limiter:
+            await rate_limiter.acquire_async()
+        started = time.monotonic()
+        try:
+            async with session.get(url, params=params) as response:
+                latency = time.monotonic() - started
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if rate_limiter:
+                    rate_limiter.on_response(response.status, latency, retry_after)
+
+                retry = policy.is_retryable(response.status) and not last_attempt
+                if not retry:
+                    response.raise_for_status()
+                    body = await response.read()
+                    if cache:
+                        cache.put(key, body)
+                    return decode(body)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if last_attempt:
+                raise
+            await asyncio.sleep(policy.backoff(attempt))
+            continue
+
+        if retry_after is None:
+            await asyncio.sleep(policy.backoff(attempt))
+        elif not rate_limiter:
+            await asyncio.sleep(retry_after)
+
+
+def iter_comment_pages(session: requests.Session, account_id: int,
+                       rate_limiter: Optional[RateLimiter] = None,
+                       retry_policy: Optional[RetryPolicy] = None,
+                       cache: Optional[ResponseCache] = None,
+                       since: Optional[datetime] = None, page_size: int = PAGE_SIZE):
+    """
+    Постранично обходит комментарии пользователя (offset/limit).
+
+    Позиция отслеживается по offset, последняя страница определяется по
+    полю count из первого ответа, поэтому каждая страница запрашивается
+    ровно один раз: всего ceil(count / page_size) запросов.
+    Если шлюз отдаёт курсор следующей страницы (next), используется он.
+    Если задан since и DATE_FILTER_PARAM, отбор по дате передаётся шлюзу.
+    Возвращает пары (count, список CommentRow страницы).
+    """
+    url = f"{API_BASE_URL}/profiles/{account_id}/comments/"
+    params = {
+        'unsafe': 'true',
+        'limit': page_size,
+        'offset': 0
     }
+    if since and DATE_FILTER_PARAM:
+        params[DATE_FILTER_PARAM] = since.isoformat()
+    offset = 0
     total_comments = None
-    processed_comments = 0
-    
-    # Вычисляем дату год назад
-    one_year_ago = datetime.now(timezone.utc) - timedelta(days=365)
-    
+
     while True:
-        try:
-            params = {
-                'unsafe': 'true'
-            }
-            
-            response = session.get(base_url, params=params)
-            response.raise_for_status()
-            data = response.json()
-            
-            if total_comments is None:
-                total_comments = data.get('count', 0)
-            
-            if not data.get('data'):
+        data = fetch_json(session, url, params, rate_limiter, retry_policy, cache,
+                          decode=decode_comment_page)
+
+        if total_comments is None:
+            total_comments = data.count
+
+        page = data.rows
+        if not page:
+            break
+
+        yield total_comments, page
+
+        offset += len(page)
+        next_url = data.next
+        # Последняя страница: по count, а без него — по неполной странице
+        # (шлюз может урезать limit, поэтому неполная страница при известном
+        # count ещё не означает конец)
+        if (offset >= total_comments) if total_comments else len(page) < page_size:
+            break
+
+        if next_url:
+            url, params = next_url, None
+        else:
+            params = dict(params, offset=offset)
+
+
+def get_user_comments(session: requests.Session, account_id: int,
+                      rate_limiter: Optional[RateLimiter] = None,
+                      retry_policy: Optional[RetryPolicy] = None,
+                      cache: Optional[ResponseCache] = None,
+                      watermarks: Optional[WatermarkStore] = None,
+                      stop_event: Optional[threading.Event] = None,
+                      verbose: bool = True, query: Optional[CommentQuery] = None) -> UserComments:
+    """
+    Получает все комментарии пользователя по его ID и разделяет их на группы
+    (колонка group возвращаемого пакета)
+
+    С watermarks собираются только комментарии новее отметки прошлого
+    обхода. Сама отметка здесь не сдвигается: самый новый комментарий
+    возвращается в UserComments.newest, и сборщик сохраняет его только после
+    записи пользователя в журнал.
+    stop_event прерывает обход между страницами (квоты уже набраны);
+    такой результат помечается complete=False.
+    Если страницу не удалось получить и после повторов, исключение
+    пробрасывается: неполный результат не выдаётся за обработанного
+    пользователя (не попадает в журнал и не сдвигает отметку).
+    verbose=False отключает построчный прогресс (нужно при параллельном обходе)
+    query задаёт размер страницы, окно в днях и порог голосов.
+    """
+    query = query or DEFAULT_COMMENT_QUERY
+    batches = []
+    processed_comments = 0
+    total_processed = 0
+
+    # Вычисляем начало окна (по умолчанию год назад)
+    one_year_ago = query.since()
+    cutoff = int(one_year_ago.timestamp())
+
+    since_id = watermarks.get(account_id) if watermarks else None
+    newest = None
+    complete = True
+
+    try:
+        pages = iter_comment_pages(session, account_id, rate_limiter, retry_policy, cache,
+                                   since=one_year_ago, page_size=query.page_size)
+        for total_comments, page in pages:
+            if newest is None:
+                newest = page[0]
+            processed_comments += len(page)
+            batch, reached_cutoff = classify_page(page, cutoff, since_id, query.min_votes)
+            batches.append(batch)
+            total_processed += len(batch)
+
+            if verbose:
+                progress = (processed_comments / total_comments) * 100 if total_comments > 0 else 0
+                print(f"\rПолучено: {processed_comments}/{total_comments} ({progress:.1f}%), Учтено: {total_processed}", end='')
+
+            if reached_cutoff:
                 break
-                
-            processed_comments += len(data['data'])
-            
-            for comment in data['data']:
-                rating = comment.get('rating', {})
-                likes = rating.get('likes', 0)
-                dislikes = rating.get('dislikes', 0)
-                
-                # Пропускаем комментарии без лайков и дизлайков
-                # или с суммой лайков и дизлайков меньше 5
-                if likes + dislikes < 5:
-                    continue
-                
-                # Проверяем дату комментария
+            if stop_event is not None and stop_event.is_set():
+                complete = False
+                break
+
+    finally:
+        if verbose:
+            print()  # Новая строка после прогресс-бара
+    return UserComments(CommentBatch.concat(batches), newest and (newest.id, newest.date_added), complete)
+
+
+class CrawlJournal:
+    """
+    Журнал обхода (JSON Lines, только дозапись): одна строка на
+    обработанного пользователя с его собранными комментариями.
+
+    Строка пишется сразу после пользователя и сбрасывается в файл,
+    каждые sync_every строк — fsync. По журналу прерванный обход
+    восстанавливается без повторных запросов к сети.
+    """
+
+    def __init__(self, path: str, resume: bool = False, sync_every: int = JOURNAL_SYNC_EVERY):
+        self.path = path
+        self.sync_every = sync_every
+        self.pending = 0
+        self.file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        if resume and self.file.tell() > 0:
+            # Отделяем возможную недописанную строку прерванного запуска
+            self.file.write('\n')
+
+    @staticmethod
+    def entries(path: str) -> Iterator[Tuple[int, CommentBatch]]:
+        """
+        Построчно читает журнал: пары (пользователь, пакет комментариев).
+        Недописанная последняя строка пропускается. Журнал целиком
+        в память не загружается.
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, encoding='utf-8') as f:
+            for line in f:
                 try:
-                    date_added = datetime.fromisoformat(comment['date_added'].replace('Z', '+00:00'))
-                    if date_added < one_year_ago:
-                        break
-                except (ValueError, KeyError):
+                    entry = json.loads(line)
+                except ValueError:
                     continue
-                    
-                comment_obj = Comment(
-                    id=comment['id'],
-                    likes=likes,
-                    dislikes=dislikes,
-                    user_vote=rating.get('user_vote', 0),
-                    status=comment['status'],
-                    ban=comment.get('ban'),
-                    date_added=date_added,
-                    url=f'https://t-j.ru/{comment["article_path"]}/#c{comment["id"]}'
-                )
-                
-                # Распределяем комментарии по группам
-                if likes > 0 and dislikes > 0:
-                    comments['both'].append(comment_obj)
-                elif likes > 0:
-                    comments['only_likes'].append(comment_obj)
-                elif dislikes > 0:
-                    comments['only_dislikes'].append(comment_obj)
-            
-            total_processed = len(comments['only_likes']) + len(comments['only_dislikes']) + len(comments['both'])
-            progress = (processed_comments / total_comments) * 100 if total_comments > 0 else 0
-            print(f"\rПолучено: {processed_comments}/{total_comments} ({progress:.1f}%), Учтено: {total_processed}", end='')
-            
-            if len(data['data']) < 100:  # Используем фиксированное значение для проверки
+                yield entry['user_id'], CommentBatch.from_lists(entry['comments'])
+
+    def record(self, user_id: int, user_comments: CommentBatch) -> None:
+        entry = {
+            'user_id': user_id,
+            'comments': user_comments.to_lists()
+        }
+        self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.file.flush()
+        self.pending += 1
+        if self.pending >= self.sync_every:
+            os.fsync(self.file.fileno())
+            self.pending = 0
+
+    def close(self) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+
+class CsvSink:
+    """
+    Потоковая выгрузка в CSV: строки каждого обработанного пользователя
+    дописываются через csv.writer в буферизованный файл и сбрасываются
+    на диск, поэтому память не зависит от объёма данных, а частичный
+    результат доступен во время обхода. Колонки — прежнего формата.
+    """
+
+    HEADER = ('id', 'group', 'likes', 'dislikes', 'user_vote', 'status', 'ban', 'date_added', 'url')
+
+    def __init__(self, path: str = OUTPUT_PATH, buffer_size: int = CSV_BUFFER_SIZE):
+        self.path = path
+        self.file = open(path, 'w', newline='', encoding='utf-8', buffering=buffer_size)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.HEADER)
+
+    def write(self, account_id: int, batch: CommentBatch) -> None:
+        if not len(batch):
+            return
+        columns = batch.columns
+        ids = columns['id'].tolist()
+        bans = ['' if ban < 0 else ban == 1 for ban in columns['ban'].tolist()]
+        dates = [datetime.fromtimestamp(timestamp, timezone.utc) for timestamp in columns['timestamp'].tolist()]
+        urls = [f"https://t-j.ru/{path}/#c{comment_id}"
+                for path, comment_id in zip(columns['article_path'], ids)]
+        self.writer.writerows(zip(
+            ids,
+            np.array(GROUPS, dtype=object)[columns['group']],
+            columns['likes'].tolist(),
+            columns['dislikes'].tolist(),
+            columns['user_vote'].tolist(),
+            columns['status'],
+            bans,
+            dates,
+            urls,
+        ))
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ParquetSink:
+    """
+    Потоковая выгрузка в Parquet (pyarrow): пакеты копятся до row_group_size
+    строк и пишутся отдельной группой строк со сжатием zstd. Колонки
+    типизированы: счётчики — int32/int8, дата — timestamp UTC, группа
+    и статус — словарные (dictionary) строки.
+    """
+
+    def __init__(self, path: str, row_group_size: int = PARQUET_ROW_GROUP_SIZE,
+                 compression: str = PARQUET_COMPRESSION):
+        # pyarrow необязателен и тяжёл, импортируется только для этой выгрузки
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Для выгрузки в Parquet нужен пакет pyarrow") from None
+        self.pa = pa
+        self.schema = pa.schema([
+            ('id', pa.int64()),
+            ('group', pa.dictionary(pa.int8(), pa.string())),
+            ('likes', pa.int32()),
+            ('dislikes', pa.int32()),
+            ('user_vote', pa.int8()),
+            ('status', pa.dictionary(pa.int32(), pa.string())),
+            ('ban', pa.bool_()),
+            ('date_added', pa.timestamp('s', tz='UTC')),
+            ('url', pa.string()),
+        ])
+        self.path = path
+        self.row_group_size = row_group_size
+        self.pending: List[CommentBatch] = []
+        self.pending_rows = 0
+        self.writer = pq.ParquetWriter(path, self.schema, compression=compression)
+
+    def write(self, account_id: int, batch: CommentBatch) -> None:
+        if not len(batch):
+            return
+        self.pending.append(batch)
+        self.pending_rows += len(batch)
+        if self.pending_rows >= self.row_group_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        columns = CommentBatch.concat(self.pending).columns
+        self.pending = []
+        self.pending_rows = 0
+        ids = columns['id']
+        urls = [f"https://t-j.ru/{path}/#c{comment_id}"
+                for path, comment_id in zip(columns['article_path'], ids.tolist())]
+        pa = self.pa
+        table = pa.Table.from_arrays([
+            pa.array(ids),
+            pa.DictionaryArray.from_arrays(pa.array(columns['group']), pa.array(GROUPS)),
+            pa.array(columns['likes']),
+            pa.array(columns['dislikes']),
+            pa.array(columns['user_vote']),
+            pa.array(columns['status'], pa.string()).dictionary_encode(),
+            pa.array(columns['ban'] == 1, mask=columns['ban'] < 0),
+            pa.array(columns['timestamp'], pa.timestamp('s', tz='UTC')),
+            pa.array(urls, pa.string()),
+        ], schema=self.schema)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+
+    def close(self) -> None:
+        if self.writer is None:
+            return
+        self.flush()
+        self.writer.close()
+        self.writer = None
+
+
+class SqliteSink:
+    """
+    Выгрузка в локальную базу SQLite (WAL): строки копятся до batch_size
+    и вставляются одним executemany в транзакции. Повторная вставка
+    комментария с тем же id обновляет запись (upsert), поэтому повторные
+    обходы сливаются с базой без дублей. Индексы по account_id,
+    date_added и group позволяют выбирать срезы без полной загрузки.
+    """
+
+    UPSERT = (
+        'INSERT INTO comments (id, account_id, "group", likes, dislikes, user_vote, status, ban, date_added, url) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT(id) DO UPDATE SET account_id = excluded.account_id, "group" = excluded."group", '
+        'likes = excluded.likes, dislikes = excluded.dislikes, user_vote = excluded.user_vote, '
+        'status = excluded.status, ban = excluded.ban, date_added = excluded.date_added, url = excluded.url'
+    )
+
+    def __init__(self, path: str, batch_size: int = SQLITE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.pending = []
+        # Базу могут одновременно дописывать процессы шардов: ждём блокировку
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS comments ('
+            'id INTEGER PRIMARY KEY, account_id INTEGER NOT NULL, "group" TEXT NOT NULL, '
+            'likes INTEGER NOT NULL, dislikes INTEGER NOT NULL, user_vote INTEGER, '
+            'status TEXT, ban INTEGER, date_added TEXT, url TEXT)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS comments_account_id ON comments (account_id)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS comments_date_added ON comments (date_added)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS comments_group ON comments ("group")')
+
+    def write(self, account_id: int, batch: CommentBatch) -> None:
+        if not len(batch):
+            return
+        columns = batch.columns
+        ids = columns['id'].tolist()
+        self.pending.extend(zip(
+            ids,
+            [account_id] * len(ids),
+            np.array(GROUPS, dtype=object)[columns['group']],
+            columns['likes'].tolist(),
+            columns['dislikes'].tolist(),
+            columns['user_vote'].tolist(),
+            columns['status'],
+            [None if ban < 0 else ban for ban in columns['ban'].tolist()],
+            [datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+             for timestamp in columns['timestamp'].tolist()],
+            [f"https://t-j.ru/{path}/#c{comment_id}" for path, comment_id in zip(columns['article_path'], ids)],
+        ))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        self.conn.execute('BEGIN')
+        try:
+            self.conn.executemany(self.UPSERT, self.pending)
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+        self.pending = []
+
+    def close(self) -> None:
+        if self.conn is None:
+            return
+        self.flush()
+        self.conn.close()
+        self.conn = None
+
+
+SINKS = {'csv': CsvSink, 'parquet': ParquetSink}
+
+
+class SeenIds:
+    """
+    Множество уже собранных id комментариев в памяти — для обычных запусков
+    """
+
+    def __init__(self):
+        self.ids = set()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def fresh(self, ids: np.ndarray) -> np.ndarray:
+        """
+        Маска id, встреченных впервые (повторы внутри пакета тоже отсекаются);
+        сами id не запоминаются — для этого add
+        """
+        seen = self.ids
+        batch = set()
+        mask = np.zeros(len(ids), dtype=bool)
+        for row, comment_id in enumerate(ids.tolist()):
+            if comment_id not in seen and comment_id not in batch:
+                batch.add(comment_id)
+                mask[row] = True
+        return mask
+
+    def add(self, ids: np.ndarray) -> None:
+        self.ids.update(ids.tolist())
+
+
+class BloomFilter:
+    """
+    Фильтр Блума по id комментариев для очень больших обходов: память
+    фиксирована (capacity элементов при доле ложных срабатываний error_rate),
+    ценой редкого пропуска нового комментария как уже виденного.
+    С path битовый массив лежит в файле (np.memmap) и не занимает оперативную
+    память; reset=True обнуляет файл, иначе фильтр продолжает прошлый запуск.
+    """
+
+    def __init__(self, capacity: int = BLOOM_CAPACITY, error_rate: float = BLOOM_ERROR_RATE,
+                 path: Optional[str] = None, reset: bool = False):
+        bits = int(-capacity * np.log(error_rate) / np.log(2) ** 2)
+        self.size = -(-bits // 8) * 8
+        self.hashes = max(1, round(self.size / capacity * np.log(2)))
+        if path is None:
+            self.bits = np.zeros(self.size // 8, dtype=np.uint8)
+        else:
+            exists = os.path.exists(path) and not reset
+            if exists and os.path.getsize(path) != self.size // 8:
+                raise ValueError(f"Размер фильтра {path} не совпадает с capacity/error_rate")
+            self.bits = np.memmap(path, dtype=np.uint8, mode='r+' if exists else 'w+', shape=(self.size // 8,))
+
+    @staticmethod
+    def mix(values: np.ndarray) -> np.ndarray:
+        # splitmix64: переполнение uint64 здесь намеренное
+        values = values + np.uint64(0x9E3779B97F4A7C15)
+        values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return values ^ (values >> np.uint64(31))
+
+    def positions(self, ids: np.ndarray) -> np.ndarray:
+        """
+        Номера битов для каждого id: двойное хеширование, форма (hashes, len(ids))
+        """
+        keys = ids.astype(np.uint64)
+        first = self.mix(keys)
+        second = self.mix(keys ^ np.uint64(0xD6E8FEB86659FD93)) | np.uint64(1)
+        steps = np.arange(self.hashes, dtype=np.uint64)[:, None]
+        return (first + steps * second) % np.uint64(self.size)
+
+    def locate(self, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Байты и сдвиги битов для каждого id
+        """
+        positions = self.positions(ids)
+        return positions >> np.uint64(3), (positions & np.uint64(7)).astype(np.uint8)
+
+    def fresh(self, ids: np.ndarray) -> np.ndarray:
+        """
+        Маска id, (вероятно) встреченных впервые; сами id не запоминаются — для этого add
+        """
+        mask = np.zeros(len(ids), dtype=bool)
+        if not len(ids):
+            return mask
+        # Повторы внутри пакета отсекаются точно, остальное — по фильтру
+        unique, first = np.unique(ids, return_index=True)
+        bytes_, offsets = self.locate(unique)
+        present = ((self.bits[bytes_] >> offsets) & 1).all(axis=0)
+        mask[first[~present]] = True
+        return mask
+
+    def add(self, ids: np.ndarray) -> None:
+        if not len(ids):
+            return
+        bytes_, offsets = self.locate(np.unique(ids))
+        np.bitwise_or.at(self.bits, bytes_.ravel(), (np.uint8(1) << offsets).ravel())
+
+    def close(self) -> None:
+        if isinstance(self.bits, np.memmap):
+            self.bits.flush()
+
+
+class CommentCollector:
+    """
+    Потокобезопасно объединяет результаты пользователей в общий набор групп
+    и следит за квотами: когда каждая группа набрала targets[group]
+    комментариев, выставляется stop_event, и обход прекращается.
+    Если задан journal, каждый пользователь записывается в журнал обхода.
+    Комментарии передаются в sinks (потоковая выгрузка); сам сборщик
+    держит только счётчики по группам.
+    С dedup (SeenIds или BloomFilter) повторно встреченные id отбрасываются
+    до подсчёта, журнала и выгрузки.
+    С watermarks отметка пользователя сдвигается только после записи
+    в журнал: при сбое между ними пользователь просто обходится заново.
+    С shared_counts (multiprocessing.Array по GROUPS) и stop_event
+    (multiprocessing.Event) квоты общие для нескольких процессов: каждый
+    прибавляет свои комментарии к общим счётчикам, и первый, кто увидит
+    заполненные группы, останавливает всех.
+    """
+
+    def __init__(self, total_users: Optional[int], targets: Optional[Dict[str, int]] = None,
+                 journal: Optional[CrawlJournal] = None, sinks: Iterable = (),
+                 dedup=None, watermarks: Optional[WatermarkStore] = None,
+                 shared_counts=None, stop_event=None):
+        self.group_counts = np.zeros(len(GROUPS), dtype=np.int64)
+        self.likes = np.zeros(len(GROUPS), dtype=np.int64)
+        self.dislikes = np.zeros(len(GROUPS), dtype=np.int64)
+        self.processed_users = 0
+        self.total_users = total_users
+        self.targets = targets if targets is not None else {group: GROUP_TARGET for group in GROUPS}
+        self.journal = journal
+        self.sinks = list(sinks)
+        self.dedup = dedup
+        self.watermarks = watermarks
+        self.duplicates = 0
+        self.failed_users = 0
+        self.shared_counts = shared_counts
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        self.lock = threading.Lock()
+
+    def restore(self, entries: Iterable[Tuple[int, CommentBatch]]) -> set:
+        """
+        Подгружает результаты прошлого запуска по мере чтения журнала
+        (см. CrawlJournal.entries) и возвращает множество обработанных пользователей
+        """
+        done_users = set()
+        with self.lock:
+            for user_id, batch in entries:
+                # Журнал уже без повторов: id только запоминаются
+                if self.dedup is not None:
+                    self.dedup.add(batch.columns['id'])
+                self.accept(user_id, batch)
+                done_users.add(user_id)
+            self.processed_users += len(done_users)
+            self.check_quotas()
+        return done_users
+
+    def accept(self, user_id: int, batch: CommentBatch) -> None:
+        """
+        Учитывает пакет в счётчиках и передаёт его в выгрузку
+        """
+        groups = batch.columns['group']
+        counts = batch.group_counts()
+        self.group_counts += counts
+        if self.shared_counts is not None:
+            with self.shared_counts.get_lock():
+                for code, count in enumerate(counts.tolist()):
+                    self.shared_counts[code] += count
+        self.likes += np.bincount(groups, weights=batch.columns['likes'], minlength=len(GROUPS)).astype(np.int64)
+        self.dislikes += np.bincount(groups, weights=batch.columns['dislikes'], minlength=len(GROUPS)).astype(np.int64)
+        for sink in self.sinks:
+            sink.write(user_id, batch)
+
+    def count(self, group: str) -> int:
+        """
+        Сколько комментариев группы собрано для квоты (с shared_counts — всеми процессами)
+        """
+        counts = self.group_counts if self.shared_counts is None else self.shared_counts
+        return int(counts[GROUPS.index(group)])
+
+    def group_stats(self) -> Dict[str, tuple]:
+        """
+        Для каждой непустой группы: (количество, сумма лайков, сумма дизлайков)
+        """
+        return {group: (int(self.group_counts[code]), int(self.likes[code]), int(self.dislikes[code]))
+                for code, group in enumerate(GROUPS) if self.group_counts[code]}
+
+    def check_quotas(self) -> None:
+        if self.targets and not any(self.missing().values()) and not self.done:
+            print("Все группы заполнены, сбор останавливается")
+            self.stop_event.set()
+
+    def missing(self) -> Dict[str, int]:
+        """
+        Сколько комментариев ещё не хватает в каждой группе
+        """
+        return {group: max(0, target - self.count(group))
+                for group, target in self.targets.items()}
+
+    @property
+    def done(self) -> bool:
+        return self.stop_event.is_set()
+
+    def fail(self, user_id: int, error: Exception) -> None:
+        """
+        Пользователь не обработан: в журнал не пишется и при --resume будет обойден заново
+        """
+        with self.lock:
+            self.failed_users += 1
+            report_user_failure(user_id, error)
+
+    def add(self, user_id: int, result: UserComments) -> None:
+        if not result.complete:
+            # Обход прерван квотами: неполного пользователя не выгружаем и не
+            # журналируем, чтобы при --resume он был обойден целиком
+            return
+
+        user_comments = result.batch
+        with self.lock:
+            if self.dedup is not None:
+                fresh = self.dedup.fresh(user_comments.columns['id'])
+                self.duplicates += len(fresh) - int(fresh.sum())
+                user_comments = user_comments.select(fresh)
+
+            # Сначала выгрузка, затем журнал: всё, что есть в журнале, уже на диске.
+            # id отмечаются виденными только после журнала, иначе после сбоя
+            # фильтр на диске отсеял бы комментарии, которых нет в выгрузке
+            self.accept(user_id, user_comments)
+            if self.journal:
+                self.journal.record(user_id, user_comments)
+            if self.dedup is not None:
+                self.dedup.add(user_comments.columns['id'])
+            if self.watermarks and result.newest is not None:
+                self.watermarks.set(user_id, *result.newest)
+
+            self.processed_users += 1
+
+            # Выводим статистику
+            print(f"\nОбработано пользователей: {self.processed_users}/{self.total_users or '?'}")
+            print(f"Только лайки: {self.count('only_likes')}/{self.targets.get('only_likes', '-')}")
+            print(f"Только дизлайки: {self.count('only_dislikes')}/{self.targets.get('only_dislikes', '-')}")
+            print(f"И лайки, и дизлайки: {self.count('both')}/{self.targets.get('both', '-')}")
+
+            self.check_quotas()
+
+
+def report_user_failure(user_id: int, error: Exception) -> None:
+    print(f"Ошибка при обработке пользователя {user_id}: {error}")
+
+
+def make_session(cookies=None, pool_size: int = 10) -> requests.Session:
+    """
+    Создаёт сессию с пулом keep-alive соединений и стандартными заголовками
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(HEADERS)
+    if cookies:
+        session.cookies.update(cookies)
+    return session
+
+
+def crawl_users_threaded(user_ids: Iterable[int], cookies, on_user_done,
+                         rate_limiter: Optional[RateLimiter] = None,
+                         retry_policy: Optional[RetryPolicy] = None,
+                         cache: Optional[ResponseCache] = None,
+                         watermarks: Optional[WatermarkStore] = None,
+                         stop_event: Optional[threading.Event] = None, workers: int = 10,
+                         query: Optional[CommentQuery] = None, on_user_failed=report_user_failure) -> None:
+    """
+    Обходит пользователей в пуле из workers потоков.
+    У каждого потока своя сессия; в работе держится не больше 2 * workers задач.
+    После stop_event новые пользователи не планируются, ещё не начатые
+    задачи отменяются, а начатые завершаются на ближайшей странице.
+    Для пользователя, которого не удалось обойти, вызывается on_user_failed(user_id, error).
+    """
+    local = threading.local()
+
+    def fetch(user_id: int):
+        if not hasattr(local, 'session'):
+            local.session = make_session(cookies)
+        return get_user_comments(local.session, user_id, rate_limiter, retry_policy,
+                                 cache, watermarks, stop_event, verbose=False, query=query)
+
+    def finish(future) -> None:
+        user_id = futures.pop(future)
+        try:
+            user_comments = future.result()
+        except Exception as e:
+            on_user_failed(user_id, e)
+            return
+        on_user_done(user_id, user_comments)
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for user_id in user_ids:
+            if stop_event is not None and stop_event.is_set():
                 break
-                
-            time.sleep(0.5)  # Пауза 500 мс между запросами
-            
-        except requests.RequestException as e:
-            print(f"\nОшибка при получении комментариев: {e}")
+            future = executor.submit(fetch, user_id)
+            futures[future] = user_id
+            pending.add(future)
+            if len(pending) < workers * 2:
+                continue
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                finish(future)
+
+        if stop_event is not None and stop_event.is_set():
+            for future in pending:
+                future.cancel()
+
+        for future in wait(pending).done:
+            if not future.cancelled():
+                finish(future)
+
+
+async def iter_comment_pages_async(session, account_id: int,
+                                   rate_limiter: Optional[RateLimiter] = None,
+                                   retry_policy: Optional[RetryPolicy] = None,
+                                   cache: Optional[ResponseCache] = None,
+                                   since: Optional[datetime] = None, page_size: int = PAGE_SIZE):
+    """
+    Асинхронный вариант iter_comment_pages для aiohttp.ClientSession
+    """
+    url = f"{API_BASE_URL}/profiles/{account_id}/comments/"
+    params = {
+        'unsafe': 'true',
+        'limit': page_size,
+        'offset': 0
+    }
+    if since and DATE_FILTER_PARAM:
+        params[DATE_FILTER_PARAM] = since.isoformat()
+    offset = 0
+    total_comments = None
+
+    while True:
+        data = await fetch_json_async(session, url, params, rate_limiter, retry_policy, cache,
+                                      decode=decode_comment_page)
+
+        if total_comments is None:
+            total_comments = data.count
+
+        page = data.rows
+        if not page:
             break
-        except Exception as e:
-            print(f"\nНеожиданная ошибка: {e}")
+
+        yield total_comments, page
+
+        offset += len(page)
+        next_url = data.next
+        if (offset >= total_comments) if total_comments else len(page) < page_size:
             break
-    
-    print()  # Новая строка после прогресс-бара
-    return comments
 
-def parse_tj_site():
+        if next_url:
+            url, params = next_url, None
+        else:
+            params = dict(params, offset=offset)
+
+
+async def get_user_comments_async(session, account_id: int,
+                                  rate_limiter: Optional[RateLimiter] = None,
+                                  retry_policy: Optional[RetryPolicy] = None,
+                                  cache: Optional[ResponseCache] = None,
+                                  watermarks: Optional[WatermarkStore] = None,
+                                  stop_event: Optional[threading.Event] = None,
+                                  query: Optional[CommentQuery] = None) -> UserComments:
+    """
+    Асинхронно получает комментарии пользователя и разделяет их на группы
+    (отметку уровня, как и get_user_comments, не сдвигает)
+    """
+    query = query or DEFAULT_COMMENT_QUERY
+    batches = []
+    one_year_ago = query.since()
+    cutoff = int(one_year_ago.timestamp())
+    since_id = watermarks.get(account_id) if watermarks else None
+    newest = None
+    complete = True
+
+    pages = iter_comment_pages_async(session, account_id, rate_limiter, retry_policy, cache,
+                                     since=one_year_ago, page_size=query.page_size)
+    try:
+        async for _, page in pages:
+            if newest is None:
+                newest = page[0]
+            batch, reached_cutoff = classify_page(page, cutoff, since_id, query.min_votes)
+            batches.append(batch)
+            if reached_cutoff:
+                break
+            if stop_event is not None and stop_event.is_set():
+                complete = False
+                break
+    finally:
+        await pages.aclose()
+
+    return UserComments(CommentBatch.concat(batches), newest and (newest.id, newest.date_added), complete)
+
+
+async def crawl_users_async(user_ids: Iterable[int], cookies: dict, on_user_done,
+                            rate_limiter: Optional[RateLimiter] = None,
+                            retry_policy: Optional[RetryPolicy] = None,
+                            cache: Optional[ResponseCache] = None,
+                            watermarks: Optional[WatermarkStore] = None,
+                            stop_event: Optional[threading.Event] = None, concurrency: int = 10,
+                            query: Optional[CommentQuery] = None, on_user_failed=report_user_failure) -> None:
+    """
+    Обходит пользователей конкурентно: не более concurrency пользователей
+    одновременно, частота запросов задаётся общим rate_limiter.
+    Для каждого обработанного пользователя вызывает on_user_done(user_id, comments),
+    для необработанного — on_user_failed(user_id, error).
+    После stop_event оставшиеся в очереди пользователи пропускаются.
+    """
+    import aiohttp
+
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+
+    async with aiohttp.ClientSession(headers=HEADERS, cookies=cookies, connector=connector,
+                                     timeout=timeout) as session:
+
+        async def worker():
+            while True:
+                user_id = await queue.get()
+                try:
+                    if user_id is None:
+                        return
+                    if stop_event is not None and stop_event.is_set():
+                        continue
+                    try:
+                        user_comments = await get_user_comments_async(session, user_id, rate_limiter,
+                                                                      retry_policy, cache, watermarks,
+                                                                      stop_event, query)
+                    except Exception as e:
+                        on_user_failed(user_id, e)
+                        continue
+                    on_user_done(user_id, user_comments)
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        try:
+            for user_id in user_ids:
+                if stop_event is not None and stop_event.is_set():
+                    break
+                await queue.put(user_id)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+
+
+USER_ID_RANGE = re.compile(r'(\d+)-(\d+)')
+USER_ID_SAMPLE = re.compile(r'sample:(\d+)-(\d+):(\d+)(?::(\d+))?(?::(\d+))?')
+
+
+def iter_permutation(n: int, seed: int) -> Iterator[int]:
+    """
+    Псевдослучайная перестановка чисел 0..n-1 без хранения самой перестановки.
+
+    LCG по модулю m = 2^k >= n с a ≡ 1 (mod 4) и нечётным c имеет полный
+    период (теорема Халла–Добелла), т.е. проходит каждое число 0..m-1 ровно раз.
+    Выход перемешивается обратимой функцией (xorshift и умножение на нечётное),
+    значения >= n пропускаются (cycle walking). Память — O(1).
+    """
+    if n <= 0:
+        return
+    bits = max(2, (n - 1).bit_length())
+    m = 1 << bits
+    mask = m - 1
+    shift = bits // 2 or 1
+    rng = random.Random(seed)
+    a = (rng.randrange(m) & ~3) | 1
+    c = rng.randrange(m) | 1
+    mult = rng.randrange(m) | 1
+    x = rng.randrange(m)
+    for _ in range(m):
+        x = (a * x + c) & mask
+        y = x ^ (x >> shift)
+        y = (y * mult) & mask
+        y ^= y >> shift
+        if y < n:
+            yield y
+
+
+def iter_sampled_ids(start: int, stop: int, count: int, seed: int = 0, strata: int = 1) -> Iterator[int]:
+    """
+    Выдаёт count различных случайных ID из диапазона start..stop (включительно),
+    воспроизводимо для одного и того же seed.
+
+    При strata > 1 диапазон делится на равные слои, из каждого берётся
+    пропорциональная доля, а слои чередуются, так что любой префикс
+    выборки равномерно покрывает диапазон.
+    """
+    size = stop - start + 1
+    count = min(count, size)
+    if size <= 0 or count <= 0:
+        return
+    strata = max(1, min(strata, count or 1))
+    bounds = [start + size * k // strata for k in range(strata + 1)]
+    quotas = [count * (bounds[k + 1] - start) // size - count * (bounds[k] - start) // size
+              for k in range(strata)]
+    sources = [(bounds[k], iter_permutation(bounds[k + 1] - bounds[k], seed * strata + k), quotas[k])
+               for k in range(strata)]
+
+    while sources:
+        active = []
+        for low, permutation, quota in sources:
+            offset = next(permutation, None) if quota > 0 else None
+            if offset is None:
+                continue
+            yield low + offset
+            if quota > 1:
+                active.append((low, permutation, quota - 1))
+        sources = active
+
+
+def iter_id_lines(lines) -> Iterator[int]:
+    """
+    Выдаёт ID из открытого текстового потока по одному на строку и закрывает его в конце
+    """
+    try:
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield int(line)
+            except ValueError:
+                print(f"Пропущена некорректная строка с ID: {line!r}")
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+
+def open_user_ids(source: str) -> Tuple[Iterator[int], Optional[int]]:
+    """
+    Открывает источник ID пользователей и возвращает ленивый итератор по ним
+    и их количество, если оно известно заранее.
+
+    source: 'a-b' — диапазон ID включительно,
+            'sample:a-b:N[:seed[:strata]]' — N случайных ID из диапазона (см. iter_sampled_ids),
+            '-' — stdin, '*.gz' — файл, сжатый gzip, иначе — текстовый файл (ID по строке).
+    Файл открывается сразу (ошибки видны до начала обхода), а читается по мере обхода,
+    поэтому память не зависит от размера списка.
+    """
+    sample_match = USER_ID_SAMPLE.fullmatch(source)
+    if sample_match:
+        start, stop, count, seed, strata = (int(value) if value else None for value in sample_match.groups())
+        count = min(count, max(0, stop - start + 1))
+        return iter_sampled_ids(start, stop, count, seed or 0, strata or 1), count
+    range_match = USER_ID_RANGE.fullmatch(source)
+    if range_match:
+        ids = range(int(range_match.group(1)), int(range_match.group(2)) + 1)
+        return iter(ids), len(ids)
+    if source == '-':
+        return iter_id_lines(sys.stdin), None
+    if source.endswith('.gz'):
+        return iter_id_lines(gzip.open(source, 'rt')), None
+    return iter_id_lines(open(source, 'r')), None
+
+
+def is_replayable_source(source: str) -> bool:
+    """
+    Можно ли открыть источник ID повторно и получить те же ID:
+    диапазон, выборка или обычный файл, но не stdin и не канал
+    """
+    if USER_ID_SAMPLE.fullmatch(source) or USER_ID_RANGE.fullmatch(source):
+        return True
+    if source == '-':
+        return False
+    return not os.path.exists(source) or os.path.isfile(source)
+
+
+SHARD_SPEC = re.compile(r'(\d+)/(\d+)')
+
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """
+    Разбирает номер шарда вида 'i/N', где 0 <= i < N
+    """
+    match = SHARD_SPEC.fullmatch(spec)
+    if not match or not int(match.group(1)) < int(match.group(2)):
+        raise ValueError(f"Неверный шард {spec!r}: нужно i/N, 0 <= i < N")
+    return int(match.group(1)), int(match.group(2))
+
+
+def shard_of(user_id: int, count: int) -> int:
+    """
+    Номер шарда пользователя: хеш splitmix64 от ID по модулю count.
+    Не зависит от процесса и запуска, поэтому шарды не пересекаются,
+    а соседние ID (диапазоны, выборки) распределяются равномерно.
+    """
+    mask = 0xFFFFFFFFFFFFFFFF
+    value = (user_id + 0x9E3779B97F4A7C15) & mask
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & mask
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & mask
+    return (value ^ (value >> 31)) % count
+
+
+def shard_path(path: str, index: int, count: int) -> str:
+    """
+    Путь частичного файла шарда: comments.csv -> comments.shard0of4.csv
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}of{count}{ext}"
+
+
+def parse_tj_site(mode: str = 'sequential', concurrency: int = 10,
+                  requests_per_second: float = 2.0, burst: int = 5, adaptive: bool = False,
+                  max_attempts: int = 5, group_target: int = GROUP_TARGET,
+                  query: Optional[CommentQuery] = None,
+                  cache_path: Optional[str] = None, cache_ttl: float = CACHE_TTL,
+                  watermark_path: Optional[str] = None,
+                  output_path: Optional[str] = None, output_format: str = 'csv',
+                  db_path: Optional[str] = None,
+                  dedup: str = 'memory', bloom_path: Optional[str] = None,
+                  bloom_capacity: int = BLOOM_CAPACITY,
+                  journal_path: str = JOURNAL_PATH, resume: bool = False,
+                  user_ids_source: str = 'user_ids.txt',
+                  shard: Optional[Tuple[int, int]] = None,
+                  rate_limiter: Optional[RateLimiter] = None,
+                  shared_counts=None, stop_event=None) -> bool:
     """
     Функция для парсинга сайта t-j.ru
+
+    mode: 'sequential' — пользователи по очереди,
+          'async' — конкурентный обход на asyncio/aiohttp,
+          'threads' — пул из concurrency потоков
+    Все запросы проходят через общий RateLimiter(requests_per_second, burst);
+    с adaptive=True частота подстраивается под ответы сервера (AdaptiveRateLimiter).
+    Каждый запрос страницы повторяется до max_attempts раз.
+    Сбор прекращается, когда в каждой группе не меньше group_target комментариев
+    (group_target=0 — без ограничения).
+    query задаёт размер страницы, окно в днях и порог голосов (CommentQuery).
+    С cache_path ответы API кэшируются в SQLite на cache_ttl секунд.
+    С watermark_path обход инкрементальный: по каждому пользователю
+    запрашиваются только комментарии новее прошлого запуска.
+    Комментарии дописываются в output_path (по умолчанию comments.<формат>)
+    по мере обработки пользователей; output_format — 'csv' или 'parquet'.
+    С db_path комментарии дополнительно сохраняются в базу SQLite (см. SqliteSink).
+    dedup — отсев повторных id комментариев: 'memory' (SeenIds), 'bloom'
+    (BloomFilter на bloom_capacity id, с bloom_path — в файле, который
+    продолжается при resume и пересоздаётся без него) или 'none'.
+    Результаты каждого пользователя пишутся в журнал journal_path;
+    с resume=True обработанные по журналу пользователи пропускаются.
+    ID пользователей читаются лениво из user_ids_source (см. open_user_ids).
+    С shard=(i, N) обрабатываются только пользователи с shard_of(id, N) == i,
+    а выгрузка, журнал, кэш и фильтр Блума пишутся в отдельные файлы шарда
+    (см. shard_path); база db_path и отметки watermark_path общие.
+    Готовый rate_limiter (например, общий для процессов шардов) заменяет
+    создаваемый по requests_per_second и burst; shared_counts и stop_event
+    делают квоту групп общей для процессов (см. CommentCollector).
+    Возвращает True, если обход дошёл до конца (отдельные необработанные
+    пользователи не в счёт — их подберёт --resume), и False при аварии.
     """
-    session = requests.Session()
-    
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-        'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'Connection': 'keep-alive',
-        'Upgrade-Insecure-Requests': '1',
-        'Sec-Fetch-Dest': 'document',
-        'Sec-Fetch-Mode': 'navigate',
-        'Sec-Fetch-Site': 'none',
-        'Sec-Fetch-User': '?1',
-        'Cache-Control': 'max-age=0'
-    }
-    
-    session.headers.update(headers)
-    
+    output_path = output_path or f"comments.{output_format}"
+    if shard:
+        shard_index, shard_count = shard
+        output_path = shard_path(output_path, shard_index, shard_count)
+        journal_path = shard_path(journal_path, shard_index, shard_count)
+        cache_path = cache_path and shard_path(cache_path, shard_index, shard_count)
+        bloom_path = bloom_path and shard_path(bloom_path, shard_index, shard_count)
+    session = make_session()
+    if rate_limiter is None:
+        limiter_class = AdaptiveRateLimiter if adaptive else RateLimiter
+        rate_limiter = limiter_class(requests_per_second, burst)
+    retry_policy = RetryPolicy(max_attempts=max_attempts)
+    cache = ResponseCache(cache_path, cache_ttl) if cache_path else None
+    watermarks = WatermarkStore(watermark_path) if watermark_path else None
+    journal = None
+    sinks = []
+    seen = None
+
     try:
+        rate_limiter.acquire()
         response = session.get('https://t-j.ru')
         response.raise_for_status()
         print("Куки получены успешно")
         print(f"Полученные куки: {dict(session.cookies)}")
-        
-        # Инициализируем общий результат
-        all_comments = {
-            'only_likes': [],
-            'only_dislikes': [],
-            'both': []
-        }
-        
-        processed_users = 0
-        
-        # Читаем ID пользователей из файла
+
+        # Открываем источник ID пользователей
         try:
-            with open('user_ids.txt', 'r') as f:
-                user_ids = [int(line.strip()) for line in f if line.strip()]
+            user_ids, total_users = open_user_ids(user_ids_source)
         except FileNotFoundError:
-            print("Файл user_ids.txt не найден")
-            return
-        except ValueError as e:
-            print(f"Ошибка при чтении ID пользователей: {e}")
-            return
-        
-        print(f"Загружено {len(user_ids)} ID пользователей")
-        
-        # Обрабатываем пользователей последовательно
-        for user_id in user_ids:
-            try:
-                print(f"\nОбработка пользователя ID: {user_id}")
-                user_comments = get_user_comments(session, user_id)
-                
-                # Объединяем результаты
-                all_comments['only_likes'].extend(user_comments['only_likes'])
-                all_comments['only_dislikes'].extend(user_comments['only_dislikes'])
-                all_comments['both'].extend(user_comments['both'])
-                
-                processed_users += 1
-                
-                # Выводим статистику
-                print(f"\nОбработано пользователей: {processed_users}/{len(user_ids)}")
-                print(f"Только лайки: {len(all_comments['only_likes'])}/2000")
-                print(f"Только дизлайки: {len(all_comments['only_dislikes'])}/2000")
-                print(f"И лайки, и дизлайки: {len(all_comments['both'])}/2000")
-                
-                # Пауза между запросами разных пользователей
-                if processed_users < len(user_ids):  # Не делаем паузу после последнего пользователя
-                    time.sleep(0.5)
-                
-            except Exception as e:
-                print(f"Ошибка при обработке пользователя {user_id}: {e}")
-        
+            print(f"Файл {user_ids_source} не найден")
+            return False
+
+        if shard:
+            user_ids = (user_id for user_id in user_ids if shard_of(user_id, shard_count) == shard_index)
+            total_users = None
+            print(f"Шард {shard_index}/{shard_count}")
+        if total_users is not None:
+            print(f"Будет обработано {total_users} ID пользователей")
+
+        # Инициализируем общий результат
+        targets = {group: group_target for group in GROUPS} if group_target else {}
+        journal = CrawlJournal(journal_path, resume=resume)
+        sinks.append(SINKS[output_format](output_path))
+        if db_path:
+            sinks.append(SqliteSink(db_path))
+        if dedup == 'bloom':
+            # Без --resume выгрузка пишется заново, значит и фильтр тоже
+            seen = BloomFilter(bloom_capacity, path=bloom_path, reset=not resume)
+        elif dedup == 'memory':
+            seen = SeenIds()
+        collector = CommentCollector(total_users, targets, journal, sinks=sinks, dedup=seen,
+                                     watermarks=watermarks, shared_counts=shared_counts,
+                                     stop_event=stop_event)
+        if resume:
+            # Выгрузка пересобирается из журнала, дальше дописывается по ходу обхода
+            done_users = collector.restore(CrawlJournal.entries(journal_path))
+            user_ids = (user_id for user_id in user_ids if user_id not in done_users)
+            print(f"Восстановлено из журнала: {len(done_users)} пользователей")
+
+        if mode == 'async':
+            asyncio.run(crawl_users_async(user_ids, dict(session.cookies), collector.add,
+                                          rate_limiter, retry_policy, cache, watermarks,
+                                          collector.stop_event,
+                                          concurrency=concurrency, query=query,
+                                          on_user_failed=collector.fail))
+        elif mode == 'threads':
+            crawl_users_threaded(user_ids, session.cookies, collector.add,
+                                 rate_limiter, retry_policy, cache, watermarks,
+                                 collector.stop_event, workers=concurrency, query=query,
+                                 on_user_failed=collector.fail)
+        else:
+            # Обрабатываем пользователей последовательно
+            for user_id in user_ids:
+                if collector.done:
+                    break
+                try:
+                    print(f"\nОбработка пользователя ID: {user_id}")
+                    user_comments = get_user_comments(session, user_id, rate_limiter, retry_policy, cache, watermarks,
+                                                      collector.stop_event, query=query)
+                except Exception as e:
+                    collector.fail(user_id, e)
+                    continue
+                collector.add(user_id, user_comments)
+
         # Выводим финальную статистику
         print("\nФинальная статистика:")
-        for group_name, group_comments in all_comments.items():
-            if group_comments:
-                total_likes = sum(comment.likes for comment in group_comments)
-                total_dislikes = sum(comment.dislikes for comment in group_comments)
-                count = len(group_comments)
-                
-                avg_likes = total_likes / count
-                avg_dislikes = total_dislikes / count
-                
-                print(f"\n{group_name.upper()}:")
-                print(f"Количество комментариев: {count}")
-                print(f"Среднее количество лайков: {avg_likes:.2f}")
-                print(f"Среднее количество дизлайков: {avg_dislikes:.2f}")
-                print(f"Общее количество лайков: {total_likes}")
-                print(f"Общее количество дизлайков: {total_dislikes}")
-        
-        # Сохраняем все комментарии в CSV
-        print("\nСохранение комментариев в CSV...")
-        
-        # Создаем список всех комментариев
-        all_comments_list = []
-        for group_name, comments in all_comments.items():
-            for comment in comments:
-                all_comments_list.append({
-                    'id': comment.id,
-                    'group': group_name,
-                    'likes': comment.likes,
-                    'dislikes': comment.dislikes,
-                    'user_vote': comment.user_vote,
-                    'status': comment.status,
-                    'ban': comment.ban,
-                    'date_added': comment.date_added,
-                    'url': comment.url
-                })
-        
-        # Создаем DataFrame и сохраняем в CSV
-        df = pd.DataFrame(all_comments_list)
-        df.to_csv('comments.csv', index=False)
-        print("Комментарии сохранены в файл comments.csv")
-        
+        if collector.duplicates:
+            print(f"Отброшено повторных комментариев: {collector.duplicates}")
+        if collector.failed_users:
+            print(f"Не удалось обработать пользователей: {collector.failed_users} (будут обойдены при --resume)")
+        for group_name, (count, total_likes, total_dislikes) in collector.group_stats().items():
+            avg_likes = total_likes / count
+            avg_dislikes = total_dislikes / count
+
+            print(f"\n{group_name.upper()}:")
+            print(f"Количество комментариев: {count}")
+            print(f"Среднее количество лайков: {avg_likes:.2f}")
+            print(f"Среднее количество дизлайков: {avg_dislikes:.2f}")
+            print(f"Общее количество лайков: {total_likes}")
+            print(f"Общее количество дизлайков: {total_dislikes}")
+
+        # Комментарии уже выгружены по ходу обхода, дописываем остаток
+        for sink in sinks:
+            sink.close()
+        print(f"Комментарии сохранены в файл {output_path}")
+        if db_path:
+            print(f"Комментарии сохранены в базу {db_path}")
+        return True
+
     except requests.RequestException as e:
         print(f"Ошибка при получении куки: {e}")
+        return False
     except Exception as e:
         print(f"Неожиданная ошибка: {e}")
+        return False
+    finally:
+        if cache:
+            cache.close()
+        if watermarks:
+            watermarks.close()
+        if journal:
+            journal.close()
+        for sink in sinks:
+            sink.close()
+        if isinstance(seen, BloomFilter):
+            seen.close()
+
+
+def merge_shards(output_path: str, output_format: str, count: int) -> bool:
+    """
+    Объединяет частичные выгрузки count шардов в output_path и удаляет их.
+    CSV склеиваются без повторных заголовков, Parquet — по группам строк.
+    Если выгрузки хотя бы одного шарда нет, ничего не объединяется.
+    """
+    parts = [shard_path(output_path, index, count) for index in range(count)]
+    missing = [part for part in parts if not os.path.exists(part)]
+    if missing:
+        print(f"Нет выгрузок шардов: {', '.join(missing)}; объединение пропущено")
+        return False
+
+    if output_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        writer = None
+        for part in parts:
+            with open(part, 'rb') as f:
+                source = pq.ParquetFile(f)
+                if writer is None:
+                    writer = pq.ParquetWriter(output_path, source.schema_arrow, compression=PARQUET_COMPRESSION)
+                for group in range(source.num_row_groups):
+                    writer.write_table(source.read_row_group(group))
+        writer.close()
+    else:
+        with open(output_path, 'wb') as merged:
+            for number, part in enumerate(parts):
+                with open(part, 'rb') as f:
+                    header = f.readline()
+                    if number == 0:
+                        merged.write(header)
+                    shutil.copyfileobj(f, merged, CSV_BUFFER_SIZE)
+
+    for part in parts:
+        os.remove(part)
+    print(f"Объединено частей: {len(parts)}, результат в файле {output_path}")
+    return True
+
+
+def run_shard(settings: dict, shard: Tuple[int, int]) -> None:
+    """
+    Тело процесса шарда: код выхода 1, если обход шарда завершился аварией
+    """
+    sys.exit(0 if parse_tj_site(shard=shard, **settings) else 1)
+
+
+def run_shards(count: int, settings: dict) -> bool:
+    """
+    Локальный координатор: запускает count процессов parse_tj_site с
+    параметрами settings, каждый на своём шарде ID (см. shard_of) и со своей
+    сессией. Лимит запросов общий: корзина токенов лежит в разделяемой
+    памяти (RateLimiter с shared=True), так что все процессы вместе не
+    превышают requests_per_second. Квота групп тоже общая: счётчики групп
+    и событие остановки разделяются процессами, и сбор прекращается сразу,
+    как только группы заполнены суммарно. Разбор JSON
+    и фильтрация идут в отдельных процессах и масштабируются по ядрам.
+    После успешного завершения всех процессов выгрузки шардов объединяются;
+    если хоть один шард упал, частичные файлы остаются для --resume.
+    Каждый процесс сам открывает источник ID, поэтому источник должен
+    читаться повторно: stdin и другие потоки (каналы) не подходят.
+    """
+    source = settings.get('user_ids_source', 'user_ids.txt')
+    if not is_replayable_source(source):
+        print(f"Источник ID {source!r} читается один раз и не делится между шардами: "
+              f"укажите файл, диапазон или выборку")
+        return False
+    settings = dict(settings)
+    limiter_class = AdaptiveRateLimiter if settings.get('adaptive') else RateLimiter
+    settings['rate_limiter'] = limiter_class(settings.get('requests_per_second', 2.0), settings.get('burst', 5),
+                                             shared=True)
+    settings['shared_counts'] = multiprocessing.Array('q', len(GROUPS))
+    settings['stop_event'] = multiprocessing.Event()
+
+    processes = [multiprocessing.Process(target=run_shard, args=(settings, (index, count)), name=f"shard-{index}")
+                 for index in range(count)]
+    for process in processes:
+        process.start()
+    failed = []
+    for process in processes:
+        process.join()
+        if process.exitcode:
+            print(f"Процесс {process.name} завершился с кодом {process.exitcode}")
+            failed.append(process.name)
+    if failed:
+        print(f"Шарды с ошибками: {', '.join(failed)}; выгрузки не объединены, "
+              f"перезапустите с --resume")
+        return False
+
+    output_format = settings.get('output_format', 'csv')
+    return merge_shards(settings.get('output_path') or f"comments.{output_format}", output_format, count)
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"нужно целое число не меньше 1: {value}")
+    return number
+
+
+def non_negative_int(value: str) -> int:
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"нужно целое неотрицательное число: {value}")
+    return number
+
+
+def non_negative_float(value: str) -> float:
+    number = float(value)
+    if not number >= 0:
+        raise argparse.ArgumentTypeError(f"нужно неотрицательное число: {value}")
+    return number
+
 
 def main():
-    parse_tj_site()
+    parser = argparse.ArgumentParser(description='Сбор и анализ комментариев t-j.ru')
+
+    source = parser.add_argument_group('источник и выгрузка')
+    source.add_argument('--users', default='user_ids.txt',
+                        help="источник ID: файл (в т.ч. .gz), диапазон вида 1-5000000, "
+                             "случайная выборка sample:1-5000000:100000[:seed[:strata]] или '-' для stdin "
+                             "(по умолчанию %(default)s)")
+    source.add_argument('--output', help='файл выгрузки (по умолчанию comments.<формат>)')
+    source.add_argument('--format', choices=sorted(SINKS), default='csv',
+                        help='формат выгрузки: csv или parquet (нужен pyarrow), по умолчанию %(default)s')
+    source.add_argument('--db', help='дополнительно сохранять комментарии в базу SQLite по этому пути')
+
+    selection = parser.add_argument_group('отбор комментариев')
+    selection.add_argument('--min-votes', type=non_negative_int, default=MIN_VOTES,
+                           help='минимальная сумма лайков и дизлайков (по умолчанию %(default)s)')
+    selection.add_argument('--days', type=non_negative_int, default=CUTOFF_DAYS,
+                           help='собирать комментарии не старше стольких дней (по умолчанию %(default)s)')
+    selection.add_argument('--group-target', type=non_negative_int, default=GROUP_TARGET,
+                           help='остановить сбор, когда в каждой группе столько комментариев; '
+                                '0 — без ограничения (по умолчанию %(default)s)')
+    selection.add_argument('--dedup', choices=('memory', 'bloom', 'none'), default='memory',
+                           help='отсев повторных комментариев: множество в памяти, фильтр Блума '
+                                'или без отсева (по умолчанию %(default)s)')
+    selection.add_argument('--bloom-path', help='файл фильтра Блума, продолжается при --resume')
+    selection.add_argument('--bloom-capacity', type=positive_int, default=BLOOM_CAPACITY,
+                           help='на сколько id рассчитан фильтр Блума (по умолчанию %(default)s)')
+
+    crawl = parser.add_argument_group('производительность обхода')
+    crawl.add_argument('--mode', choices=('sequential', 'threads', 'async'), default='sequential',
+                       help='последовательно, пул потоков или asyncio/aiohttp (по умолчанию %(default)s)')
+    crawl.add_argument('--concurrency', type=positive_int, default=10,
+                       help='число потоков или одновременных пользователей (по умолчанию %(default)s)')
+    crawl.add_argument('--rate', type=non_negative_float, default=2.0,
+                       help='общий лимит запросов в секунду, 0 — без лимита (по умолчанию %(default)s)')
+    crawl.add_argument('--burst', type=positive_int, default=5,
+                       help='допустимый всплеск запросов (по умолчанию %(default)s)')
+    crawl.add_argument('--adaptive', action='store_true',
+                       help='подстраивать частоту запросов под ответы сервера')
+    crawl.add_argument('--max-attempts', type=positive_int, default=5,
+                       help='попыток на один запрос страницы (по умолчанию %(default)s)')
+    crawl.add_argument('--page-size', type=positive_int, default=PAGE_SIZE,
+                       help='комментариев на страницу API (по умолчанию %(default)s)')
+
+    state = parser.add_argument_group('кэш и состояние обхода')
+    state.add_argument('--cache', help='файл SQLite-кэша ответов API (по умолчанию кэш выключен)')
+    state.add_argument('--cache-ttl', type=non_negative_float, default=CACHE_TTL,
+                       help='время жизни записей кэша в секундах (по умолчанию %(default)s)')
+    state.add_argument('--watermarks', help='файл отметок для инкрементального обхода')
+    state.add_argument('--journal', default=JOURNAL_PATH, help='журнал обхода (по умолчанию %(default)s)')
+    state.add_argument('--resume', action='store_true',
+                       help='продолжить прерванный обход по журналу, пропуская обработанных пользователей')
+
+    sharding = parser.add_argument_group('шарды')
+    sharding.add_argument('--shards', type=positive_int, default=1,
+                          help='запустить столько процессов, каждый на своей части ID, '
+                               'и объединить их выгрузки (по умолчанию %(default)s)')
+    sharding.add_argument('--shard', type=parse_shard,
+                          help='обработать только шард i/N (0 <= i < N), выгрузка пишется в частичный файл')
+    sharding.add_argument('--merge-shards', type=positive_int, metavar='N',
+                          help='только объединить частичные выгрузки N шардов')
+    args = parser.parse_args()
+
+    query = CommentQuery(page_size=args.page_size, cutoff_days=args.days, min_votes=args.min_votes)
+    settings = dict(mode=args.mode, concurrency=args.concurrency,
+                    requests_per_second=args.rate, burst=args.burst, adaptive=args.adaptive,
+                    max_attempts=args.max_attempts, group_target=args.group_target, query=query,
+                    cache_path=args.cache, cache_ttl=args.cache_ttl, watermark_path=args.watermarks,
+                    output_path=args.output, output_format=args.format, db_path=args.db,
+                    dedup=args.dedup, bloom_path=args.bloom_path, bloom_capacity=args.bloom_capacity,
+                    journal_path=args.journal, resume=args.resume, user_ids_source=args.users)
+
+    if args.merge_shards:
+        ok = merge_shards(args.output or f"comments.{args.format}", args.format, args.merge_shards)
+    elif args.shards > 1 and args.shard is None:
+        ok = run_shards(args.shards, settings)
+    else:
+        ok = parse_tj_site(shard=args.shard, **settings)
+    sys.exit(0 if ok else 1)
 
 if __name__ == "__main__":
     main()